@@ -1,14 +1,16 @@
 '''
 Stripped down version from https://github.com/vsergeev/python-periphery/blob/master/periphery/mmio.py
 '''
+import ctypes
 import mmap
 import os
-import struct
-import sys
+import weakref
 
-# Alias long to int on Python 3
-if sys.version_info[0] >= 3:
-    long = int
+
+def _unmap(cells, mapping):
+    # the cached views must go before the mapping can be closed
+    cells.clear()
+    mapping.close()
 
 
 class MMIOError(IOError):
@@ -21,8 +23,8 @@ class MMIO(object):
         """Instantiate an MMIO object and map the region of physical memory
         specified by the address base `physaddr` and size `size` in bytes.
         Args:
-            physaddr (int, long): base physical address of memory region.
-            size (int, long): size of memory region.
+            physaddr (int): base physical address of memory region.
+            size (int): size of memory region.
         Returns:
             MMIO: MMIO object.
         Raises:
@@ -30,11 +32,9 @@ class MMIO(object):
             TypeError: if `physaddr` or `size` types are invalid.
         """
         self.mapping = None
+        self._cells = {}
         self._open(physaddr, size)
 
-    def __del__(self):
-        self.close()
-
     def __enter__(self):
         pass
 
@@ -42,9 +42,9 @@ class MMIO(object):
         self.close()
 
     def _open(self, physaddr, size):
-        if not isinstance(physaddr, (int, long)):
+        if not isinstance(physaddr, int):
             raise TypeError("Invalid physaddr type, should be integer.")
-        if not isinstance(size, (int, long)):
+        if not isinstance(size, int):
             raise TypeError("Invalid size type, should be integer.")
 
         pagesize = os.sysconf(os.sysconf_names['SC_PAGESIZE'])
@@ -61,14 +61,20 @@ class MMIO(object):
 
         try:
             self.mapping = mmap.mmap(
-                fd, self._aligned_size, flags=mmap.MAP_SHARED, prot=mmap.PROT_WRITE, offset=self._aligned_physaddr)
+                fd,
+                self._aligned_size,
+                flags=mmap.MAP_SHARED,
+                prot=mmap.PROT_READ | mmap.PROT_WRITE,
+                offset=self._aligned_physaddr,
+            )
         except OSError as e:
             raise MMIOError(e.errno, "Mapping /dev/mem: " + e.strerror)
-
-        try:
+        finally:
+            # the mapping holds its own reference to the file
             os.close(fd)
-        except OSError as e:
-            raise MMIOError(e.errno, "Closing /dev/mem: " + e.strerror)
+
+        # unmap when the object is garbage collected, unless close() is called first
+        self._finalizer = weakref.finalize(self, _unmap, self._cells, self.mapping)
 
     # Methods
 
@@ -79,51 +85,78 @@ class MMIO(object):
         if (offset + length) > self._aligned_size:
             raise ValueError("Offset out of bounds.")
 
+    def _get_cell(self, offset, ctype):
+        # views on the mapping are cached, so repeated accesses skip the offset math and the bounds check
+        key = (offset, ctype)
+        cell = self._cells.get(key)
+        if cell is None:
+            adjusted_offset = self._adjust_offset(offset)
+            self._validate_offset(adjusted_offset, ctypes.sizeof(ctype))
+            cell = self._cells[key] = ctype.from_buffer(self.mapping, adjusted_offset)
+        return cell
+
     def read32(self, offset):
         """Read 32-bits from the specified `offset` in bytes, relative to the
         base physical address of the MMIO region.
         Args:
-            offset (int, long): offset from base physical address, in bytes.
+            offset (int): offset from base physical address, in bytes.
         Returns:
             int: 32-bit value read.
         Raises:
-            TypeError: if `offset` type is invalid.
             ValueError: if `offset` is out of bounds.
         """
-        if not isinstance(offset, (int, long)):
-            raise TypeError("Invalid offset type, should be integer.")
-
-        offset = self._adjust_offset(offset)
-        self._validate_offset(offset, 4)
-        return struct.unpack("=L", self.mapping[offset:offset + 4])[0]
+        # access the register with a single 32-bit load
+        return self._get_cell(offset, ctypes.c_uint32).value
 
     def write32(self, offset, value):
         """Write 32-bits to the specified `offset` in bytes, relative to the
         base physical address of the MMIO region.
         Args:
-            offset (int, long): offset from base physical address, in bytes.
-            value (int, long): 32-bit value to write.
+            offset (int): offset from base physical address, in bytes.
+            value (int): 32-bit value to write.
         Raises:
-            TypeError: if `offset` or `value` type are invalid.
             ValueError: if `offset` or `value` are out of bounds.
         """
-        if not isinstance(offset, (int, long)):
-            raise TypeError("Invalid offset type, should be integer.")
-        if not isinstance(value, (int, long)):
-            raise TypeError("Invalid value type, should be integer.")
         if value < 0 or value > 0xffffffff:
             raise ValueError("Value out of bounds.")
 
-        offset = self._adjust_offset(offset)
-        self._validate_offset(offset, 4)
-        self.mapping[offset:offset + 4] = struct.pack("=L", value)
+        # access the register with a single 32-bit store
+        self._get_cell(offset, ctypes.c_uint32).value = value
+
+    def read64(self, offset):
+        """Read 64-bits from the specified `offset` in bytes, relative to the
+        base physical address of the MMIO region.
+        Args:
+            offset (int): offset from base physical address, in bytes.
+        Returns:
+            int: 64-bit value read.
+        Raises:
+            ValueError: if `offset` is out of bounds.
+        """
+        # access the register with a single 64-bit load
+        return self._get_cell(offset, ctypes.c_uint64).value
+
+    def write64(self, offset, value):
+        """Write 64-bits to the specified `offset` in bytes, relative to the
+        base physical address of the MMIO region.
+        Args:
+            offset (int): offset from base physical address, in bytes.
+            value (int): 64-bit value to write.
+        Raises:
+            ValueError: if `offset` or `value` are out of bounds.
+        """
+        if value < 0 or value > 0xffffffffffffffff:
+            raise ValueError("Value out of bounds.")
+
+        # access the register with a single 64-bit store
+        self._get_cell(offset, ctypes.c_uint64).value = value
 
     def close(self):
         """Unmap the MMIO object's mapped physical memory."""
         if self.mapping is None:
             return
 
-        self.mapping.close()
+        self._finalizer()
         self.mapping = None
 
         self._fd = None
@@ -1,23 +1,21 @@
 #!/usr/bin/env python3
-from __future__ import print_function
 
 import argparse
+import atexit
 import configparser
 import glob
 import gzip
+import math
 import os
 import re
 import struct
 import subprocess
 import sys
-from collections import defaultdict
-from datetime import datetime
-from errno import EACCES, EIO, EPERM
-from multiprocessing import cpu_count
+from collections import OrderedDict, defaultdict
+from errno import EACCES, EIO, ENOENT, ENXIO, EPERM
+from functools import lru_cache, partial
 from platform import uname
-from subprocess import check_output, CalledProcessError
-from threading import Event, Thread
-from time import time
+from time import localtime, monotonic, strftime, time
 
 import dbus
 from dbus.mainloop.glib import DBusGMainLoop
@@ -25,6 +23,11 @@ from gi.repository import GLib
 from mmio import MMIO, MMIOError
 
 DEFAULT_SYSFS_POWER_PATH = '/sys/class/power_supply/AC*/online'
+PCI_HOST_BRIDGE_CONFIG = '/sys/bus/pci/devices/0000:00:00.0/config'
+MONITOR_IDLE_POWER_W = 5.0
+MONITOR_IDLE_MAX_WAIT = 5.0
+POWERCAP_RAPL_PATH = '/sys/class/powercap'
+POWERCAP_POWER_PLANES = {'package-0': 'Package', 'uncore': 'Graphics', 'dram': 'DRAM'}
 VOLTAGE_PLANES = {'CORE': 0, 'GPU': 1, 'CACHE': 2, 'UNCORE': 3, 'ANALOGIO': 4}
 CURRENT_PLANES = {'CORE': 0, 'GPU': 1, 'CACHE': 2}
 TRIP_TEMP_RANGE = [40, 97]
@@ -47,9 +50,34 @@ MSR_DICT = {
     'IA32_HWP_REQUEST': 0x774,
 }
 
+# package scoped MSRs: every CPU of a package reads back the same value and writing it from one
+# CPU per physical package is enough. MSR_TEMPERATURE_TARGET is left out since it is thread scoped
+# on older parts (e.g. Nehalem, SandyBridge)
+PACKAGE_MSRS = frozenset(
+    (
+        'MSR_RAPL_POWER_UNIT',
+        'MSR_PKG_POWER_LIMIT',
+        'MSR_INTEL_PKG_ENERGY_STATUS',
+        'MSR_CONFIG_TDP_CONTROL',
+    )
+)
+
 HWP_PERFORMANCE_VALUE = 0x20
 HWP_DEFAULT_VALUE = 0x80
 HWP_INTERVAL = 60
+MSR_STRUCT = struct.Struct('<Q')
+SLEEP_MATCH_RULE = (
+    "type='signal',sender='org.freedesktop.login1',"
+    "interface='org.freedesktop.login1.Manager',member='PrepareForSleep'"
+)
+UPOWER_MATCH_RULE = (
+    "type='signal',interface='org.freedesktop.DBus.Properties',"
+    "member='PropertiesChanged',path='/org/freedesktop/UPower',arg0='org.freedesktop.UPower'"
+)
+CPUINFO_FIELDS_RE = re.compile(r'^(vendor_id|cpu family|model|stepping)\s*:\s*(.*?)\s*$', re.MULTILINE)
+CPUINFO_FLAGS_RE = re.compile(r'^flags\s*:\s*(.*?)\s*$', re.MULTILINE)
+# PL1 enable, PL1 clamping and PL2 enable bits of MSR_PKG_POWER_LIMIT
+PKG_POWER_LIMIT_FLAGS = (1 << 15) | (1 << 16) | (1 << 47)
 
 
 platform_info_bits = {
@@ -86,6 +114,19 @@ thermal_status_bits = {
     'reading_valid': [31, 31],
 }
 
+
+def bits_to_masks(bits):
+    # turn [from_bit, to_bit] ranges into (shift, mask) pairs, so that each field is a single shift and AND
+    return {key: (from_bit, (1 << (to_bit - from_bit + 1)) - 1) for key, (from_bit, to_bit) in bits.items()}
+
+
+platform_info_masks = bits_to_masks(platform_info_bits)
+thermal_status_masks = bits_to_masks(thermal_status_bits)
+# (label, shift, mask) of every thermal status field, as printed in the debug output
+THERMAL_STATUS_FIELDS = tuple(
+    (key.replace('_', ' '), shift, mask) for key, (shift, mask) in thermal_status_masks.items()
+)
+
 supported_cpus = {
     (6, 26, 1): 'Nehalem',
     (6, 26, 2): 'Nehalem-EP',
@@ -176,6 +217,11 @@ supported_cpus = {
     (6, 186, 3): 'RaptorLake-U',
 }
 
+# fallback for steppings missing from supported_cpus, named after the first listed stepping of the same model
+supported_cpu_models = {
+    (family, model): name for (family, model, _stepping), name in reversed(list(supported_cpus.items()))
+}
+
 TESTMSR = False
 UNSUPPORTED_FEATURES = []
 
@@ -192,49 +238,153 @@ OK = bcolors.GREEN + bcolors.BOLD + 'OK' + bcolors.RESET
 ERR = bcolors.RED + bcolors.BOLD + 'ERR' + bcolors.RESET
 LIM = bcolors.YELLOW + bcolors.BOLD + 'LIM' + bcolors.RESET
 
-log_history = set()
+# oneshot messages already printed, least recently seen first
+log_history = OrderedDict()
+LOG_HISTORY_SIZE = 512
+msr_paths = None
+msr_fds = None
+msr_package_cpus = None
+sysfs_power_fd = None
+
+
+def get_timestamp():
+    # same as datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3], without the datetime object
+    now = time()
+    return '{:s}.{:03d}'.format(strftime('%Y-%m-%d %H:%M:%S', localtime(now)), int(now % 1 * 1000))
+
+
+def add_log_history(msg, oneshot):
+    # returns whether the message should be printed, oneshot messages are only printed once
+    if not oneshot:
+        return True
+    key = msg.strip()
+    if key in log_history:
+        # keep recurring messages from being evicted and printed again
+        log_history.move_to_end(key)
+        return False
+    log_history[key] = None
+    # bounded, so that oneshot messages with changing values cannot grow it forever
+    if len(log_history) > LOG_HISTORY_SIZE:
+        log_history.popitem(last=False)
+    return True
 
 
 def log(msg, oneshot=False, end='\n'):
+    if not add_log_history(msg, oneshot):
+        return
     outfile = args.log if args.log else sys.stdout
-    if msg.strip() not in log_history or oneshot is False:
-        tstamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
-        full_msg = '{:s}: {:s}'.format(tstamp, msg) if args.log else msg
-        print(full_msg, file=outfile, end=end)
-        log_history.add(msg.strip())
+    full_msg = '{:s}: {:s}'.format(get_timestamp(), msg) if args.log else msg
+    print(full_msg, file=outfile, end=end)
 
 
 def fatal(msg, code=1, end='\n'):
     outfile = args.log if args.log else sys.stderr
-    tstamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
-    full_msg = '{:s}: [E] {:s}'.format(tstamp, msg) if args.log else '[E] {:s}'.format(msg)
+    full_msg = '{:s}: [E] {:s}'.format(get_timestamp(), msg) if args.log else '[E] {:s}'.format(msg)
     print(full_msg, file=outfile, end=end)
     sys.exit(code)
 
 
 def warning(msg, oneshot=True, end='\n'):
+    if not add_log_history(msg, oneshot):
+        return
     outfile = args.log if args.log else sys.stderr
-    if msg.strip() not in log_history or oneshot is False:
-        tstamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
-        full_msg = '{:s}: [W] {:s}'.format(tstamp, msg) if args.log else '[W] {:s}'.format(msg)
-        print(full_msg, file=outfile, end=end)
-        log_history.add(msg.strip())
+    full_msg = '{:s}: [W] {:s}'.format(get_timestamp(), msg) if args.log else '[W] {:s}'.format(msg)
+    print(full_msg, file=outfile, end=end)
 
 
-def writemsr(msr, val):
-    msr_list = ['/dev/cpu/{:d}/msr'.format(x) for x in range(cpu_count())]
-    if not os.path.exists(msr_list[0]):
+def get_msr_paths():
+    global msr_paths
+    if msr_paths is None:
+        if not os.path.exists('/dev/cpu/0/msr'):
+            try:
+                subprocess.check_call(('modprobe', 'msr'))
+            except subprocess.CalledProcessError:
+                fatal('Unable to load the msr module.')
+        # /dev/cpu only lists the online CPUs, so this follows CPU hotplug unlike cpu_count()
+        cpus = sorted(int(entry.name) for entry in os.scandir('/dev/cpu') if entry.name.isdigit())
+        msr_paths = ['/dev/cpu/{:d}/msr'.format(cpu) for cpu in cpus]
+    return msr_paths
+
+
+def refresh_msr_paths():
+    global msr_paths, msr_package_cpus
+    close_msr_fds()
+    msr_paths = None
+    msr_package_cpus = None
+    return get_msr_paths()
+
+
+def get_msr_package_cpus():
+    # indexes in get_msr_paths() of the first online CPU of each physical package
+    global msr_package_cpus
+    if msr_package_cpus is None:
+        package_cpus = {}
+        for index, path in enumerate(get_msr_paths()):
+            cpu = int(os.path.basename(os.path.dirname(path)))
+            try:
+                with open('/sys/devices/system/cpu/cpu{:d}/topology/physical_package_id'.format(cpu)) as f:
+                    package_id = int(f.read())
+            except (IOError, ValueError):
+                # unknown topology, the CPU is handled as a package of its own rather than skipped
+                package_id = ('cpu', cpu)
+            package_cpus.setdefault(package_id, index)
+        msr_package_cpus = sorted(package_cpus.values())
+    return msr_package_cpus
+
+
+def get_msr_fds():
+    global msr_fds
+    if msr_fds is None:
+        fds = []
         try:
-            subprocess.check_call(('modprobe', 'msr'))
-        except subprocess.CalledProcessError:
-            fatal('Unable to load the msr module.')
+            for path in get_msr_paths():
+                fds.append(os.open(path, os.O_RDWR))
+        except OSError:
+            for fd in fds:
+                os.close(fd)
+            raise
+        msr_fds = fds
+    return msr_fds
+
+
+def close_msr_fds():
+    global msr_fds
+    if msr_fds is None:
+        return
+    for fd in msr_fds:
+        os.close(fd)
+    msr_fds = None
+
+
+def writemsr(msr, val, cpu=None):
+    writemsrs(((msr, val),), cpu)
+
+
+# writes several MSRs with a single pass over the CPUs
+def writemsrs(values, cpu=None, retry=True):
+    values = list(values)
+    if not values:
+        return
+    assert cpu is None or cpu in range(len(get_msr_paths()))
+    payloads = [(msr, MSR_STRUCT.pack(val)) for msr, val in values]
+    # package scoped MSRs are shared by the CPUs of a package, so they are only written through the first one
+    core_payloads = [(msr, payload) for msr, payload in payloads if msr not in PACKAGE_MSRS]
+    msr = values[0][0]
     try:
-        for addr in msr_list:
-            f = os.open(addr, os.O_WRONLY)
-            os.lseek(f, MSR_DICT[msr], os.SEEK_SET)
-            os.write(f, struct.pack('Q', val))
-            os.close(f)
+        fds = get_msr_fds()
+        if cpu is not None:
+            targets = ((fds[cpu], payloads),)
+        else:
+            package_cpus = get_msr_package_cpus()
+            targets = ((fd, payloads if index in package_cpus else core_payloads) for index, fd in enumerate(fds))
+        for fd, fd_payloads in targets:
+            for msr, payload in fd_payloads:
+                os.pwrite(fd, payload, MSR_DICT[msr])
     except (IOError, OSError) as e:
+        if retry and (e.errno == ENOENT or e.errno == ENXIO):
+            # the set of online CPUs changed (hotplug), rescan and try again once
+            refresh_msr_paths()
+            return writemsrs(values, cpu, retry=False)
         if TESTMSR:
             raise e
         if e.errno == EPERM or e.errno == EACCES:
@@ -249,30 +399,32 @@ def writemsr(msr, val):
 
 
 # returns the value between from_bit and to_bit as unsigned long
-def readmsr(msr, from_bit=0, to_bit=63, cpu=None, flatten=False):
-    assert cpu is None or cpu in range(cpu_count())
+def readmsr(msr, from_bit=0, to_bit=63, cpu=None, flatten=False, retry=True):
+    assert cpu is None or cpu in range(len(get_msr_paths()))
     if from_bit > to_bit:
         fatal('Wrong readmsr bit params')
-    msr_list = ['/dev/cpu/{:d}/msr'.format(x) for x in range(cpu_count())]
-    if not os.path.exists(msr_list[0]):
-        try:
-            subprocess.check_call(('modprobe', 'msr'))
-        except subprocess.CalledProcessError:
-            fatal('Unable to load the msr module.')
     try:
+        fds = get_msr_fds()
+        if cpu is not None and not flatten:
+            val = MSR_STRUCT.unpack(os.pread(fds[cpu], 8, MSR_DICT[msr]))[0]
+            return get_value_for_bits(val, from_bit, to_bit)
+        if msr in PACKAGE_MSRS:
+            # a package register only needs to be read once per physical package
+            fds = [fds[index] for index in get_msr_package_cpus()]
         output = []
-        for addr in msr_list:
-            f = os.open(addr, os.O_RDONLY)
-            os.lseek(f, MSR_DICT[msr], os.SEEK_SET)
-            val = struct.unpack('Q', os.read(f, 8))[0]
-            os.close(f)
+        for fd in fds:
+            val = MSR_STRUCT.unpack(os.pread(fd, 8, MSR_DICT[msr]))[0]
             output.append(get_value_for_bits(val, from_bit, to_bit))
         if flatten:
             if len(set(output)) > 1:
                 warning('Found multiple values for {:s} ({:x}). This should never happen.'.format(msr, MSR_DICT[msr]))
             return output[0]
-        return output[cpu] if cpu is not None else output
+        return output
     except (IOError, OSError) as e:
+        if retry and (e.errno == ENOENT or e.errno == ENXIO):
+            # the set of online CPUs changed (hotplug), rescan and try again once
+            refresh_msr_paths()
+            return readmsr(msr, from_bit, to_bit, cpu, flatten, retry=False)
         if TESTMSR:
             raise e
         if e.errno == EPERM or e.errno == EACCES:
@@ -284,8 +436,22 @@ def readmsr(msr, from_bit=0, to_bit=63, cpu=None, flatten=False):
 
 
 def get_value_for_bits(val, from_bit=0, to_bit=63):
-    mask = sum(2 ** x for x in range(from_bit, to_bit + 1))
-    return (val & mask) >> from_bit
+    return (val >> from_bit) & ((1 << (to_bit - from_bit + 1)) - 1)
+
+
+def make_msr_reader(msr, from_bit=0, to_bit=63, cpu=0):
+    # reads a fixed bit range of a MSR, with the address and the mask resolved once for the monitoring loop
+    addr = MSR_DICT[msr]
+    mask = (1 << (to_bit - from_bit + 1)) - 1
+
+    def read():
+        try:
+            return (MSR_STRUCT.unpack(os.pread(get_msr_fds()[cpu], 8, addr))[0] >> from_bit) & mask
+        except OSError:
+            # let readmsr deal with CPU hotplug and permission errors
+            return readmsr(msr, from_bit, to_bit, cpu)
+
+    return read
 
 
 def set_msr_allow_writes():
@@ -303,62 +469,119 @@ def set_msr_allow_writes():
             warning('Unable to set MSR allow_writes to on. You might experience warnings in kernel logs.')
 
 
+def get_sysfs_power_fd(config):
+    global sysfs_power_fd
+    if sysfs_power_fd is None:
+        for path in glob.glob(config.get('GENERAL', 'Sysfs_Power_Path', fallback=DEFAULT_SYSFS_POWER_PATH)):
+            sysfs_power_fd = os.open(path, os.O_RDONLY)
+            break
+    return sysfs_power_fd
+
+
+def close_sysfs_power_fd():
+    # the attribute is looked up again from the config at the next update
+    global sysfs_power_fd
+    if sysfs_power_fd is not None:
+        os.close(sysfs_power_fd)
+        sysfs_power_fd = None
+
+
 def is_on_battery(config):
     try:
-        for path in glob.glob(config.get('GENERAL', 'Sysfs_Power_Path', fallback=DEFAULT_SYSFS_POWER_PATH)):
-            with open(path) as f:
-                return not bool(int(f.read()))
-        raise
-    except:
-        warning('No valid Sysfs_Power_Path found! Trying upower method')
+        fd = get_sysfs_power_fd(config)
+        if fd is not None:
+            # the AC online attribute reads either '0' or '1'
+            return os.pread(fd, 1, 0) == b'0'
+    except OSError:
+        # the attribute might have gone away
+        close_sysfs_power_fd()
+    warning('No valid Sysfs_Power_Path found! Trying upower method')
     try:
-        bus = dbus.SystemBus()
-        proxy = bus.get_object('org.freedesktop.UPower', '/org/freedesktop/UPower')
-        iface = dbus.Interface(proxy, 'org.freedesktop.DBus.Properties')
-        return iface.Get('org.freedesktop.UPower', 'OnBattery')
-    except:
+        return is_on_battery_upower(dbus.SystemBus())
+    except dbus.DBusException:
         pass
 
     warning('No valid power detection methods found. Assuming that the system is running on battery power.')
     return True
 
 
+def watch_sysfs_power_path(config, wakeup):
+    # sysfs attributes report POLLPRI when the driver notifies a change: if the AC driver does so,
+    # update the power limits right away instead of waiting for the next update
+    paths = glob.glob(config.get('GENERAL', 'Sysfs_Power_Path', fallback=DEFAULT_SYSFS_POWER_PATH))
+    if not paths:
+        return
+    try:
+        fd = os.open(paths[0], os.O_RDONLY)
+        # changes are only reported after the attribute has been read once
+        os.read(fd, 8)
+    except OSError:
+        return
+
+    def handle_sysfs_power_callback(fd, condition):
+        # sysfs reports IO_ERR together with IO_PRI on every change, so a removed attribute
+        # (e.g. a USB-C power source going away) only shows up as a failing read
+        if not condition & GLib.IO_NVAL:
+            try:
+                os.pread(fd, 8, 0)
+            except OSError:
+                pass
+            else:
+                wakeup()
+                return True
+        # stop watching, the power source is still polled at every update
+        try:
+            os.close(fd)
+        except OSError:
+            pass
+        return False
+
+    GLib.io_add_watch(
+        fd, GLib.PRIORITY_DEFAULT, GLib.IO_PRI | GLib.IO_ERR | GLib.IO_NVAL, handle_sysfs_power_callback
+    )
+
+
+def is_on_battery_upower(bus):
+    proxy = bus.get_object('org.freedesktop.UPower', '/org/freedesktop/UPower')
+    iface = dbus.Interface(proxy, 'org.freedesktop.DBus.Properties')
+    return bool(iface.Get('org.freedesktop.UPower', 'OnBattery'))
+
+
+@lru_cache(maxsize=None)
 def get_cpu_platform_info():
     features_msr_value = readmsr('MSR_PLATFORM_INFO', cpu=0)
     cpu_platform_info = {}
-    for key, value in platform_info_bits.items():
-        cpu_platform_info[key] = int(get_value_for_bits(features_msr_value, value[0], value[1]))
+    for key, (shift, mask) in platform_info_masks.items():
+        cpu_platform_info[key] = (features_msr_value >> shift) & mask
     return cpu_platform_info
 
 
 def get_reset_thermal_status():
-    # read thermal status
-    thermal_status_msr_value = readmsr('IA32_THERM_STATUS')
-    thermal_status = []
-    for core in range(cpu_count()):
-        thermal_status_core = {}
-        for key, value in thermal_status_bits.items():
-            thermal_status_core[key] = int(get_value_for_bits(thermal_status_msr_value[core], value[0], value[1]))
-        thermal_status.append(thermal_status_core)
+    # read the raw thermal status of every core, the fields are decoded with thermal_status_masks
+    thermal_status = readmsr('IA32_THERM_STATUS')
     # reset log bits
     writemsr('IA32_THERM_STATUS', 0)
     return thermal_status
 
 
+@lru_cache(maxsize=None)
 def get_time_unit():
     # 0.000977 is the time unit of my CPU
     # TODO formula might be different for other CPUs
     return 1.0 / 2 ** readmsr('MSR_RAPL_POWER_UNIT', 16, 19, cpu=0)
 
 
+@lru_cache(maxsize=None)
 def get_power_unit():
     # 0.125 is the power unit of my CPU
     # TODO formula might be different for other CPUs
     return 1.0 / 2 ** readmsr('MSR_RAPL_POWER_UNIT', 0, 3, cpu=0)
 
 
+@lru_cache(maxsize=None)
 def get_critical_temp():
     # the critical temperature for my CPU is 100 'C
+    # TjMax and the RAPL units are read-only, so they are only read once
     return readmsr('MSR_TEMPERATURE_TARGET', 16, 23, cpu=0)
 
 
@@ -372,13 +595,19 @@ def get_cur_pkg_power_limits():
     }
 
 
-def calc_time_window_vars(t):
-    time_unit = get_time_unit()
-    for Y in range(2 ** 5):
-        for Z in range(2 ** 2):
-            if t <= (2 ** Y) * (1.0 + Z / 4.0) * time_unit:
-                return (Y, Z)
-    raise ValueError('Unable to find a good combination!')
+@lru_cache(maxsize=None)
+def calc_time_window_vars(t, time_unit):
+    # the time window is 2^Y * (1 + Z/4) * time_unit: find the smallest one >= t
+    # t / time_unit = mantissa * 2^exponent with 0.5 <= mantissa < 1, i.e. 2^Y <= t / time_unit < 2^(Y+1)
+    mantissa, exponent = math.frexp(t / time_unit)
+    if exponent < 1:
+        return (0, 0)
+    Y, Z = exponent - 1, int(math.ceil(mantissa * 8 - 4))
+    if Z == 4:
+        Y, Z = Y + 1, 0
+    if Y >= 2 ** 5:
+        raise ValueError('Unable to find a good combination!')
+    return (Y, Z)
 
 
 def calc_undervolt_msr(plane, offset):
@@ -388,14 +617,15 @@ def calc_undervolt_msr(plane, offset):
     assert offset <= 0
     assert plane in VOLTAGE_PLANES
     offset = int(round(offset * 1.024))
-    offset = 0xFFE00000 & ((offset & 0xFFF) << 21)
+    offset = (offset & 0x7FF) << 21
     return 0x8000001100000000 | (VOLTAGE_PLANES[plane] << 40) | offset
 
 
 def calc_undervolt_mv(msr_value):
     """Return the offset voltage (in mV) from the given raw MSR 150h value."""
-    offset = (msr_value & 0xFFE00000) >> 21
-    offset = offset if offset <= 0x400 else -(0x800 - offset)
+    offset = (msr_value >> 21) & 0x7FF
+    # sign extend the 11 bit two's complement value
+    offset -= (offset & 0x400) << 1
     return int(round(offset / 1.024))
 
 
@@ -405,23 +635,16 @@ def get_undervolt(plane=None, convert=False):
     planes = [plane] if plane in VOLTAGE_PLANES else VOLTAGE_PLANES
     out = {}
     for plane in planes:
-        writemsr('MSR_OC_MAILBOX', 0x8000001000000000 | (VOLTAGE_PLANES[plane] << 40))
-        read_value = readmsr('MSR_OC_MAILBOX', flatten=True) & 0xFFFFFFFF
+        # the mailbox answers on the CPU the request was sent to
+        writemsr('MSR_OC_MAILBOX', 0x8000001000000000 | (VOLTAGE_PLANES[plane] << 40), cpu=0)
+        read_value = readmsr('MSR_OC_MAILBOX', cpu=0) & 0xFFFFFFFF
         out[plane] = calc_undervolt_mv(read_value) if convert else read_value
 
     return out
 
 
-def undervolt(config):
-    if ('UNDERVOLT.{:s}'.format(power['source']) not in config and 'UNDERVOLT' not in config) or (
-        'UNDERVOLT' in UNSUPPORTED_FEATURES
-    ):
-        return
-    for plane in VOLTAGE_PLANES:
-        write_offset_mv = config.getfloat(
-            'UNDERVOLT.{:s}'.format(power['source']), plane, fallback=config.getfloat('UNDERVOLT', plane, fallback=0.0)
-        )
-        write_value = calc_undervolt_msr(plane, write_offset_mv)
+def undervolt(regs):
+    for plane, (write_offset_mv, write_value) in regs[power['source']].get('UNDERVOLT', {}).items():
         writemsr('MSR_OC_MAILBOX', write_value)
         if args.debug:
             write_value &= 0xFFFFFFFF
@@ -454,34 +677,26 @@ def get_icc_max(plane=None, convert=False):
     planes = [plane] if plane in CURRENT_PLANES else CURRENT_PLANES
     out = {}
     for plane in planes:
-        writemsr('MSR_OC_MAILBOX', 0x8000001600000000 | (CURRENT_PLANES[plane] << 40))
-        read_value = readmsr('MSR_OC_MAILBOX', flatten=True) & 0x3FF
+        writemsr('MSR_OC_MAILBOX', 0x8000001600000000 | (CURRENT_PLANES[plane] << 40), cpu=0)
+        read_value = readmsr('MSR_OC_MAILBOX', cpu=0) & 0x3FF
         out[plane] = calc_icc_max_amp(read_value) if convert else read_value
 
     return out
 
 
-def set_icc_max(config):
-    for plane in CURRENT_PLANES:
-        try:
-            write_current_amp = config.getfloat(
-                'ICCMAX.{:s}'.format(power['source']), plane, fallback=config.getfloat('ICCMAX', plane, fallback=-1.0)
+def set_icc_max(regs):
+    for plane, (write_current_amp, write_value) in regs[power['source']].get('ICCMAX', {}).items():
+        writemsr('MSR_OC_MAILBOX', write_value)
+        if args.debug:
+            write_value &= 0x3FF
+            read_value = get_icc_max(plane)[plane]
+            read_current_A = calc_icc_max_amp(read_value)
+            match = OK if write_value == read_value else ERR
+            log(
+                '[D] IccMax plane {:s} - write {:.2f} A ({:#x}) - read {:.2f} A ({:#x}) - match {}'.format(
+                    plane, write_current_amp, write_value, read_current_A, read_value, match
+                )
             )
-            if write_current_amp > 0:
-                write_value = calc_icc_max_msr(plane, write_current_amp)
-                writemsr('MSR_OC_MAILBOX', write_value)
-                if args.debug:
-                    write_value &= 0x3FF
-                    read_value = get_icc_max(plane)[plane]
-                    read_current_A = calc_icc_max_amp(read_value)
-                    match = OK if write_value == read_value else ERR
-                    log(
-                        '[D] IccMax plane {:s} - write {:.2f} A ({:#x}) - read {:.2f} A ({:#x}) - match {}'.format(
-                            plane, write_current_amp, write_value, read_current_A, read_value, match
-                        )
-                    )
-        except (configparser.NoSectionError, configparser.NoOptionError):
-            pass
 
 
 def load_config():
@@ -490,7 +705,14 @@ def load_config():
 
     # config values sanity check
     for power_source in ('AC', 'BATTERY'):
-        for option in ('Update_Rate_s', 'PL1_Tdp_W', 'PL1_Duration_s', 'PL2_Tdp_W', 'PL2_Duration_S'):
+        for option in (
+            'Update_Rate_s',
+            'Max_Update_Rate_s',
+            'PL1_Tdp_W',
+            'PL1_Duration_s',
+            'PL2_Tdp_W',
+            'PL2_Duration_S',
+        ):
             value = config.getfloat(power_source, option, fallback=None)
             if value is not None:
                 value = config.set(power_source, option, str(max(0.001, value)))
@@ -562,7 +784,28 @@ def load_config():
 
 def calc_reg_values(platform_info, config):
     regs = defaultdict(dict)
+    power_unit = get_power_unit()
+    time_unit = get_time_unit()
     for power_source in ('AC', 'BATTERY'):
+        # parse all the numeric settings of this power source in one go
+        options = {
+            option: config.getfloat(power_source, option, fallback=None)
+            for option in (
+                'Update_Rate_s',
+                'Max_Update_Rate_s',
+                'Trip_Temp_C',
+                'PL1_Tdp_W',
+                'PL1_Duration_s',
+                'PL2_Tdp_W',
+                'PL2_Duration_s',
+            )
+        }
+        # settings used by the power loop at every update
+        regs[power_source]['Update_Rate_s'] = options['Update_Rate_s']
+        regs[power_source]['Max_Update_Rate_s'] = options['Max_Update_Rate_s']
+        regs[power_source]['HWP_Mode'] = power_source == 'AC' and config.getboolean('AC', 'HWP_Mode', fallback=False)
+        regs[power_source]['Disable_BDPROCHOT'] = config.getboolean(power_source, 'Disable_BDPROCHOT', fallback=False)
+
         if platform_info['feature_programmable_temperature_target'] != 1:
             warning("Setting temperature target is not supported by this CPU")
         else:
@@ -572,19 +815,17 @@ def calc_reg_values(platform_info, config):
             global TRIP_TEMP_RANGE
             TRIP_TEMP_RANGE[1] = min(TRIP_TEMP_RANGE[1], critical_temp - 3)
 
-            Trip_Temp_C = config.getfloat(power_source, 'Trip_Temp_C', fallback=None)
+            Trip_Temp_C = options['Trip_Temp_C']
             if Trip_Temp_C is not None:
                 trip_offset = int(round(critical_temp - Trip_Temp_C))
                 regs[power_source]['MSR_TEMPERATURE_TARGET'] = trip_offset << 24
             else:
                 log('[I] {:s} trip temperature is disabled in config.'.format(power_source))
 
-        power_unit = get_power_unit()
-
-        PL1_Tdp_W = config.getfloat(power_source, 'PL1_Tdp_W', fallback=None)
-        PL1_Duration_s = config.getfloat(power_source, 'PL1_Duration_s', fallback=None)
-        PL2_Tdp_W = config.getfloat(power_source, 'PL2_Tdp_W', fallback=None)
-        PL2_Duration_s = config.getfloat(power_source, 'PL2_Duration_s', fallback=None)
+        PL1_Tdp_W = options['PL1_Tdp_W']
+        PL1_Duration_s = options['PL1_Duration_s']
+        PL2_Tdp_W = options['PL2_Tdp_W']
+        PL2_Duration_s = options['PL2_Duration_s']
 
         if (PL1_Tdp_W, PL1_Duration_s, PL2_Tdp_W, PL2_Duration_s).count(None) < 4:
             cur_pkg_power_limits = get_cur_pkg_power_limits()
@@ -598,7 +839,7 @@ def calc_reg_values(platform_info, config):
                 TW1 = cur_pkg_power_limits['TW1']
                 log('[I] {:s} PL1_Duration_s disabled in config.'.format(power_source))
             else:
-                Y, Z = calc_time_window_vars(PL1_Duration_s)
+                Y, Z = calc_time_window_vars(PL1_Duration_s, time_unit)
                 TW1 = Y | (Z << 5)
 
             if PL2_Tdp_W is None:
@@ -611,11 +852,19 @@ def calc_reg_values(platform_info, config):
                 TW2 = cur_pkg_power_limits['TW2']
                 log('[I] {:s} PL2_Duration_s disabled in config.'.format(power_source))
             else:
-                Y, Z = calc_time_window_vars(PL2_Duration_s)
+                Y, Z = calc_time_window_vars(PL2_Duration_s, time_unit)
                 TW2 = Y | (Z << 5)
 
+            # MSR_PKG_POWER_LIMIT layout:
+            #   0-14 PL1, 15 PL1 enable, 16 PL1 clamping, 17-23 TW1,
+            #   32-46 PL2, 47 PL2 enable, 49-55 TW2
+            # mask the fields so that they cannot overflow into the flag bits
             regs[power_source]['MSR_PKG_POWER_LIMIT'] = (
-                PL1 | (1 << 15) | (1 << 16) | (TW1 << 17) | (PL2 << 32) | (1 << 47) | (TW2 << 49)
+                (PL1 & 0x7FFF)
+                | ((TW1 & 0x7F) << 17)
+                | ((PL2 & 0x7FFF) << 32)
+                | ((TW2 & 0x7F) << 49)
+                | PKG_POWER_LIMIT_FLAGS
             )
         else:
             log('[I] {:s} package power limits are disabled in config.'.format(power_source))
@@ -630,6 +879,23 @@ def calc_reg_values(platform_info, config):
             else:
                 valid_c_tdp_target_value = max(0, c_tdp_target_value)
                 regs[power_source]['MSR_CONFIG_TDP_CONTROL'] = valid_c_tdp_target_value
+
+        # undervolt and IccMax mailbox values, applied on start, on config reload and on resume from sleep
+        undervolt_key = 'UNDERVOLT.{:s}'.format(power_source)
+        if (undervolt_key in config or 'UNDERVOLT' in config) and 'UNDERVOLT' not in UNSUPPORTED_FEATURES:
+            regs[power_source]['UNDERVOLT'] = {}
+            for plane in VOLTAGE_PLANES:
+                offset_mv = config.getfloat(
+                    undervolt_key, plane, fallback=config.getfloat('UNDERVOLT', plane, fallback=0.0)
+                )
+                regs[power_source]['UNDERVOLT'][plane] = (offset_mv, calc_undervolt_msr(plane, offset_mv))
+
+        iccmax_key = 'ICCMAX.{:s}'.format(power_source)
+        regs[power_source]['ICCMAX'] = {}
+        for plane in CURRENT_PLANES:
+            current_amp = config.getfloat(iccmax_key, plane, fallback=config.getfloat('ICCMAX', plane, fallback=-1.0))
+            if current_amp > 0:
+                regs[power_source]['ICCMAX'][plane] = (current_amp, calc_icc_max_msr(plane, current_amp))
     return regs
 
 
@@ -669,19 +935,33 @@ def get_config_write_time():
 
 def reload_config():
     config = load_config()
+    # Sysfs_Power_Path might have changed
+    close_sysfs_power_fd()
     regs = calc_reg_values(get_cpu_platform_info(), config)
-    undervolt(config)
-    set_icc_max(config)
+    undervolt(regs)
+    set_icc_max(regs)
     set_hwp(config.getboolean('AC', 'HWP_Mode', fallback=None))
     log('[I] Reloading changes.')
     return config, regs
 
 
-def power_thread(config, regs, exit_event, cpuid):
+def schedule_once(wait_t, callback):
+    # the callbacks return False, they reschedule themselves since the wait changes over time
+    if float(wait_t).is_integer():
+        # second granularity timeouts are batched with other wakeups of the system
+        return GLib.timeout_add_seconds(int(wait_t), callback)
+    return GLib.timeout_add(int(wait_t * 1000), callback)
+
+
+# schedules the power limit updates in the GLib main loop and returns a function to trigger an immediate update
+def power_loop(config, regs, cpuid):
     try:
-        MCHBAR_BASE = int(check_output(('setpci', '-s', '0:0.0', '48.l')), 16)
-    except CalledProcessError:
-        warning('Please ensure that "setpci" is in path. This is typically provided by the "pciutils" package.')
+        # MCHBAR register of the host bridge (same as "setpci -s 0:0.0 48.l")
+        with open(PCI_HOST_BRIDGE_CONFIG, 'rb') as f:
+            f.seek(0x48)
+            MCHBAR_BASE = struct.unpack('<I', f.read(4))[0]
+    except (IOError, struct.error):
+        warning('Unable to read the MCHBAR address from {:s}.'.format(PCI_HOST_BRIDGE_CONFIG))
         warning('Trying to guess the MCHBAR address from the CPUID. This MIGHT NOT WORK!')
         if cpuid in ((6, 140, 1),(6, 140, 2),(6, 141, 1),(6, 151, 2),(6, 151, 5), (6, 154, 3),(6, 154, 4)):
             MCHBAR_BASE = 0xFEDC0001
@@ -695,99 +975,126 @@ def power_thread(config, regs, exit_event, cpuid):
         mchbar_mmio = None
 
     next_hwp_write = 0
-    last_config_write_time = (
-        get_config_write_time() if config.getboolean('GENERAL', 'Autoreload', fallback=False) else None
-    )
-    while not exit_event.is_set():
+    idle_ticks = 0
+    last_power_source = None
+    autoreload = config.getboolean('GENERAL', 'Autoreload', fallback=False)
+    last_config_write_time = get_config_write_time() if autoreload else None
+    timeout_id = None
+    # (register, value) pairs already read back correctly in debug mode, until the next config reload
+    debug_verified = set()
+
+    def debug_readback(name, write_value, read):
+        if (name, write_value) in debug_verified:
+            return
+        read_value = read()
+        match = OK if write_value == read_value else ERR
+        log('[D] {:s} - write {:#x} - read {:#x} - match {}'.format(name, write_value, read_value, match))
+        if write_value == read_value:
+            debug_verified.add((name, write_value))
+
+    def update():
+        nonlocal config, regs, autoreload, next_hwp_write, idle_ticks, last_power_source, last_config_write_time
+        nonlocal timeout_id
+
         # log thermal status
         if args.debug:
-            thermal_status = get_reset_thermal_status()
-            for index, core_thermal_status in enumerate(thermal_status):
-                for key, value in core_thermal_status.items():
-                    log('[D] core {} thermal status: {} = {}'.format(index, key.replace("_", " "), value))
+            # the whole report is printed at once, with a single timestamp
+            log(
+                '\n'.join(
+                    '[D] core {} thermal status: {} = {}'.format(index, name, (core_msr_value >> shift) & mask)
+                    for index, core_msr_value in enumerate(get_reset_thermal_status())
+                    for name, shift, mask in THERMAL_STATUS_FIELDS
+                )
+            )
 
         # Reload config on changes (unless it's deleted)
-        if config.getboolean('GENERAL', 'Autoreload', fallback=False):
+        if autoreload:
             config_write_time = get_config_write_time()
             if config_write_time and last_config_write_time != config_write_time:
                 last_config_write_time = config_write_time
                 config, regs = reload_config()
+                debug_verified.clear()
+                autoreload = config.getboolean('GENERAL', 'Autoreload', fallback=False)
 
         # switch back to sysfs polling
         if power['method'] == 'polling':
             power['source'] = 'BATTERY' if is_on_battery(config) else 'AC'
+        power_source = power['source']
+        source_regs = regs[power_source]
+
+        max_wait_t = source_regs['Max_Update_Rate_s']
+        limits_in_place = False
+        if max_wait_t is not None and 'MSR_PKG_POWER_LIMIT' in source_regs:
+            # the power limits are still in place if nobody (i.e. the EC) has reset them since the last update
+            write_value = source_regs['MSR_PKG_POWER_LIMIT']
+            limits_in_place = (
+                power_source == last_power_source
+                and all(value == write_value for value in readmsr('MSR_PKG_POWER_LIMIT', 0, 55))
+                and (mchbar_mmio is None or mchbar_mmio.read64(0) == write_value)
+            )
+            idle_ticks = min(idle_ticks + 1, 16) if limits_in_place else 0
+        last_power_source = power_source
+
+        # set temperature trip point, cTDP and PL1/2 on MSR in a single pass over the CPUs,
+        # there is no need to write PL1/2 again when they have just been read back unchanged
+        writemsrs(
+            (msr, source_regs[msr])
+            for msr in ('MSR_TEMPERATURE_TARGET', 'MSR_CONFIG_TDP_CONTROL', 'MSR_PKG_POWER_LIMIT')
+            if msr in source_regs and not (limits_in_place and msr == 'MSR_PKG_POWER_LIMIT')
+        )
 
-        # set temperature trip point
-        if 'MSR_TEMPERATURE_TARGET' in regs[power['source']]:
-            write_value = regs[power['source']]['MSR_TEMPERATURE_TARGET']
-            writemsr('MSR_TEMPERATURE_TARGET', write_value)
-            if args.debug:
-                read_value = readmsr('MSR_TEMPERATURE_TARGET', 24, 29, flatten=True)
-                match = OK if write_value >> 24 == read_value else ERR
-                log(
-                    '[D] TEMPERATURE_TARGET - write {:#x} - read {:#x} - match {}'.format(
-                        write_value >> 24, read_value, match
-                    )
-                )
-
-        # set cTDP
-        if 'MSR_CONFIG_TDP_CONTROL' in regs[power['source']]:
-            write_value = regs[power['source']]['MSR_CONFIG_TDP_CONTROL']
-            writemsr('MSR_CONFIG_TDP_CONTROL', write_value)
-            if args.debug:
-                read_value = readmsr('MSR_CONFIG_TDP_CONTROL', 0, 1, flatten=True)
-                match = OK if write_value == read_value else ERR
-                log(
-                    '[D] CONFIG_TDP_CONTROL - write {:#x} - read {:#x} - match {}'.format(
-                        write_value, read_value, match
-                    )
-                )
+        if args.debug and 'MSR_TEMPERATURE_TARGET' in source_regs:
+            debug_readback(
+                'TEMPERATURE_TARGET',
+                source_regs['MSR_TEMPERATURE_TARGET'] >> 24,
+                lambda: readmsr('MSR_TEMPERATURE_TARGET', 24, 29, flatten=True),
+            )
 
-        # set PL1/2 on MSR
-        write_value = regs[power['source']]['MSR_PKG_POWER_LIMIT']
-        writemsr('MSR_PKG_POWER_LIMIT', write_value)
-        if args.debug:
-            read_value = readmsr('MSR_PKG_POWER_LIMIT', 0, 55, flatten=True)
-            match = OK if write_value == read_value else ERR
-            log(
-                '[D] MSR PACKAGE_POWER_LIMIT - write {:#x} - read {:#x} - match {}'.format(
-                    write_value, read_value, match
-                )
+        if args.debug and 'MSR_CONFIG_TDP_CONTROL' in source_regs:
+            debug_readback(
+                'CONFIG_TDP_CONTROL',
+                source_regs['MSR_CONFIG_TDP_CONTROL'],
+                lambda: readmsr('MSR_CONFIG_TDP_CONTROL', 0, 1, flatten=True),
             )
-        if mchbar_mmio is not None:
-            # set MCHBAR register to the same PL1/2 values
-            mchbar_mmio.write32(0, write_value & 0xFFFFFFFF)
-            mchbar_mmio.write32(4, write_value >> 32)
+
+        if 'MSR_PKG_POWER_LIMIT' in source_regs:
+            write_value = source_regs['MSR_PKG_POWER_LIMIT']
             if args.debug:
-                read_value = mchbar_mmio.read32(0) | (mchbar_mmio.read32(4) << 32)
-                match = OK if write_value == read_value else ERR
-                log(
-                    '[D] MCHBAR PACKAGE_POWER_LIMIT - write {:#x} - read {:#x} - match {}'.format(
-                        write_value, read_value, match
-                    )
+                debug_readback(
+                    'MSR PACKAGE_POWER_LIMIT', write_value, lambda: readmsr('MSR_PKG_POWER_LIMIT', 0, 55, flatten=True)
                 )
+            if mchbar_mmio is not None and not limits_in_place:
+                # set MCHBAR register to the same PL1/2 values
+                mchbar_mmio.write64(0, write_value)
+                if args.debug:
+                    debug_readback('MCHBAR PACKAGE_POWER_LIMIT', write_value, lambda: mchbar_mmio.read64(0))
 
         # Disable BDPROCHOT
-        disable_bdprochot = config.getboolean(power['source'], 'Disable_BDPROCHOT', fallback=None)
-        if disable_bdprochot:
+        if source_regs['Disable_BDPROCHOT']:
             set_disable_bdprochot()
 
-        wait_t = config.getfloat(power['source'], 'Update_Rate_s')
-        enable_hwp_mode = config.getboolean('AC', 'HWP_Mode', fallback=None)
+        wait_t = source_regs['Update_Rate_s']
+        if max_wait_t is not None:
+            # back off exponentially while the registers are not being reset
+            wait_t = max(wait_t, min(max_wait_t, wait_t * 2 ** idle_ticks))
         # set HWP less frequently. Just to be safe since (e.g.) TLP might reset this value
-        if (
-            enable_hwp_mode
-            and next_hwp_write <= time()
-            and (
-                (power['method'] == 'dbus' and power['source'] == 'AC')
-                or (power['method'] == 'polling' and not is_on_battery(config))
-            )
-        ):
-            set_hwp(enable_hwp_mode)
+        if source_regs['HWP_Mode'] and next_hwp_write <= time():
+            set_hwp(True)
             next_hwp_write = time() + HWP_INTERVAL
 
-        else:
-            exit_event.wait(wait_t)
+        timeout_id = schedule_once(wait_t, update)
+        return False
+
+    def wakeup():
+        nonlocal idle_ticks, timeout_id
+        # something changed (e.g. power source or resume from sleep), go back to the base update rate
+        idle_ticks = 0
+        if timeout_id is not None:
+            GLib.source_remove(timeout_id)
+        timeout_id = GLib.idle_add(update)
+
+    wakeup()
+    return wakeup
 
 
 def check_kernel():
@@ -810,32 +1117,23 @@ def check_kernel():
     if kernel_config is None:
         log('[W] Unable to obtain and validate kernel config.')
         return
-    elif not re.search('CONFIG_DEVMEM=y', kernel_config):
+    elif 'CONFIG_DEVMEM=y' not in kernel_config:
         warning('Bad kernel config: you need CONFIG_DEVMEM=y.')
-    if not re.search('CONFIG_X86_MSR=(y|m)', kernel_config):
+    if 'CONFIG_X86_MSR=y' not in kernel_config and 'CONFIG_X86_MSR=m' not in kernel_config:
         fatal('Bad kernel config: you need CONFIG_X86_MSR builtin or as module.')
 
 
 def check_cpu():
     try:
         with open('/proc/cpuinfo') as f:
-            cpuinfo = {}
-            for row in f.readlines():
-                try:
-                    key, value = map(lambda x: x.strip(), row.split(':'))
-                    if key == 'processor' and value == '1':
-                        break
-                    try:
-                        cpuinfo[key] = int(value, 0)
-                    except ValueError:
-                        cpuinfo[key] = value
-                except ValueError:
-                    pass
+            # the first processor block is enough
+            cpuinfo = dict(CPUINFO_FIELDS_RE.findall(f.read().split('\n\n', 1)[0]))
         if cpuinfo['vendor_id'] != 'GenuineIntel':
             fatal('This tool is designed for Intel CPUs only.')
 
-        cpuid = (cpuinfo['cpu family'], cpuinfo['model'], cpuinfo['stepping'])
-        if cpuid not in supported_cpus:
+        cpuid = (int(cpuinfo['cpu family'], 0), int(cpuinfo['model'], 0), int(cpuinfo['stepping'], 0))
+        cpu_name = supported_cpus.get(cpuid) or supported_cpu_models.get(cpuid[:2])
+        if cpu_name is None:
             fatal(
                 'Your CPU model is not supported.\n\n'
                 'Please open a new issue (https://github.com/erpalma/throttled/issues) specifying:\n'
@@ -846,7 +1144,9 @@ def check_cpu():
                 'from /proc/cpuinfo.'
             )
 
-        log('[I] Detected CPU architecture: Intel {:s}'.format(supported_cpus[cpuid]))
+        if cpuid not in supported_cpus:
+            warning('Unknown stepping {:d} of a supported CPU model, assuming it behaves the same.'.format(cpuid[2]))
+        log('[I] Detected CPU architecture: Intel {:s}'.format(cpu_name))
         return cpuid
     except SystemExit:
         sys.exit(1)
@@ -854,6 +1154,17 @@ def check_cpu():
         fatal('Unable to identify CPU model.')
 
 
+@lru_cache(maxsize=None)
+def get_cpu_flags():
+    # feature flags of the first CPU, None if they cannot be read
+    try:
+        with open('/proc/cpuinfo') as f:
+            match = CPUINFO_FLAGS_RE.search(f.read().split('\n\n', 1)[0])
+    except IOError:
+        return None
+    return frozenset(match.group(1).split()) if match else None
+
+
 def test_msr_rw_capabilities():
     TESTMSR = True
 
@@ -864,30 +1175,71 @@ def test_msr_rw_capabilities():
         warning('Undervolt seems not to be supported by your system, disabling.')
         UNSUPPORTED_FEATURES.append('UNDERVOLT')
 
-    try:
-        log('[I] Testing if HWP is supported...')
-        cur_val = readmsr('IA32_HWP_REQUEST', cpu=0)
-        writemsr('IA32_HWP_REQUEST', cur_val)
-    except:
-        warning('HWP seems not to be supported by your system, disabling.')
+    # no need to probe the HWP MSRs when the CPU does not advertise them
+    cpu_flags = get_cpu_flags()
+    if cpu_flags is not None and 'hwp' not in cpu_flags:
+        warning('HWP is not supported by your CPU, disabling.')
         UNSUPPORTED_FEATURES.append('HWP')
+    else:
+        try:
+            log('[I] Testing if HWP is supported...')
+            cur_val = readmsr('IA32_HWP_REQUEST', cpu=0)
+            writemsr('IA32_HWP_REQUEST', cur_val)
+        except:
+            warning('HWP seems not to be supported by your system, disabling.')
+            UNSUPPORTED_FEATURES.append('HWP')
 
     TESTMSR = False
 
 
-def monitor(exit_event, wait):
+def get_powercap_energy_counters():
+    # energy counters exposed by the intel-rapl powercap driver, by power plane: (energy_uj fd, counter range in uJ)
+    counters = {}
+    for name_path in sorted(glob.glob(os.path.join(POWERCAP_RAPL_PATH, 'intel-rapl:*', 'name'))):
+        zone_path = os.path.dirname(name_path)
+        try:
+            with open(name_path) as f:
+                power_plane = POWERCAP_POWER_PLANES.get(f.read().strip())
+            if power_plane is None or power_plane in counters:
+                continue
+            with open(os.path.join(zone_path, 'max_energy_range_uj')) as f:
+                energy_range = int(f.read())
+            counters[power_plane] = (os.open(os.path.join(zone_path, 'energy_uj'), os.O_RDONLY), energy_range)
+        except (OSError, ValueError):
+            pass
+    return counters
+
+
+# schedules the realtime monitoring in the GLib main loop
+def monitor(wait):
     wait = max(0.1, wait)
-    rapl_power_unit = 0.5 ** readmsr('MSR_RAPL_POWER_UNIT', from_bit=8, to_bit=12, cpu=0)
     power_plane_msr = {
         'Package': 'MSR_INTEL_PKG_ENERGY_STATUS',
         'Graphics': 'MSR_PP1_ENERGY_STATUS',
         'DRAM': 'MSR_DRAM_ENERGY_STATUS',
     }
-    prev_energy = {
-        'Package': (readmsr('MSR_INTEL_PKG_ENERGY_STATUS', cpu=0) * rapl_power_unit, time()),
-        'Graphics': (readmsr('MSR_PP1_ENERGY_STATUS', cpu=0) * rapl_power_unit, time()),
-        'DRAM': (readmsr('MSR_DRAM_ENERGY_STATUS', cpu=0) * rapl_power_unit, time()),
-    }
+    # prefer the powercap counters, the MSRs are only read for the power planes missing from sysfs
+    energy_counters = get_powercap_energy_counters()
+    energy_fds = [fd for fd, _ in energy_counters.values()]
+    if len(energy_fds) < len(power_plane_msr):
+        rapl_power_unit = 0.5 ** readmsr('MSR_RAPL_POWER_UNIT', from_bit=8, to_bit=12, cpu=0)
+
+    def close_energy_fds():
+        for fd in energy_fds:
+            os.close(fd)
+
+    def make_powercap_reader(fd):
+        return lambda: int(os.pread(fd, 32, 0))
+
+    # (raw counter reader, J per count, counter range) of each power plane, the energy MSRs are 32-bit wide
+    energy_sources = [
+        (make_powercap_reader(energy_counters[power_plane][0]), 1e-6, energy_counters[power_plane][1])
+        if power_plane in energy_counters
+        else (make_msr_reader(msr, from_bit=0, to_bit=31), rapl_power_unit, 1 << 32)
+        for power_plane, msr in power_plane_msr.items()
+    ]
+    prev_energy = [read() for read, _, _ in energy_sources]
+    prev_t = monotonic()
 
     undervolt_values = get_undervolt(convert=True)
     undervolt_output = ' | '.join('{:s}: {:.2f} mV'.format(plane, undervolt_values[plane]) for plane in VOLTAGE_PLANES)
@@ -897,35 +1249,87 @@ def monitor(exit_event, wait):
     iccmax_output = ' | '.join('{:s}: {:.2f} A'.format(plane, iccmax_values[plane]) for plane in CURRENT_PLANES)
     log('[D] IccMax: {:s}'.format(iccmax_output))
 
-    log('[D] Realtime monitoring of throttling causes:\n')
-    while not exit_event.is_set():
-        value = readmsr('IA32_THERM_STATUS', from_bit=0, to_bit=15, cpu=0)
-        offsets = {'Thermal': 0, 'Power': 10, 'Current': 12, 'Cross-domain (e.g. GPU)': 14}
-        output = ('{:s}: {:s}'.format(cause, LIM if bool((value >> offsets[cause]) & 1) else OK) for cause in offsets)
+    # throttling causes, their status bit mask in IA32_THERM_STATUS and their output for each status
+    causes = tuple(
+        (1 << offset, '{:s}: {:s}'.format(cause, OK), '{:s}: {:s}'.format(cause, LIM))
+        for cause, offset in (('Thermal', 0), ('Power', 10), ('Current', 12), ('Cross-domain (e.g. GPU)', 14))
+    )
+    causes_mask = sum(mask for mask, _, _ in causes)
+    # nothing is throttling most of the time
+    all_ok_output = ' - '.join(ok for _, ok, _ in causes)
+    terminator = '\n' if args.log else '\r'
+    # the whole status line is formatted at once
+    line_format = (
+        '[{}] {}  ||  VCore: {:.0f} mV - '
+        + ''.join('{:s}: {{:.1f}} W - '.format(power_plane) for power_plane in power_plane_msr)
+        + 'Total: {:.1f} W'
+        + ' ' * 10
+    )
+    read_thermal_status = make_msr_reader('IA32_THERM_STATUS', from_bit=0, to_bit=15)
+    read_vcore = make_msr_reader('IA32_PERF_STATUS', from_bit=32, to_bit=47)
 
-        # ugly code, just testing...
-        vcore = readmsr('IA32_PERF_STATUS', from_bit=32, to_bit=47, cpu=0) / (2.0 ** 13) * 1000
-        stats2 = {'VCore': '{:.0f} mV'.format(vcore)}
-        total = 0.0
-        for power_plane in ('Package', 'Graphics', 'DRAM'):
-            energy_j = readmsr(power_plane_msr[power_plane], cpu=0) * rapl_power_unit
-            now = time()
-            prev_energy[power_plane], energy_w = (
-                (energy_j, now),
-                (energy_j - prev_energy[power_plane][0]) / (now - prev_energy[power_plane][1]),
-            )
-            stats2[power_plane] = '{:.1f} W'.format(energy_w)
-            total += energy_w
+    # up to 4 times the requested period while idle, capped unless the requested one is already longer
+    idle_wait = max(wait, min(wait * 4, MONITOR_IDLE_MAX_WAIT))
+    package_w = None
 
-        stats2['Total'] = '{:.1f} W'.format(total)
+    def tick():
+        nonlocal package_w, prev_t
 
-        output2 = ('{:s}: {:s}'.format(label, stats2[label]) for label in stats2)
-        terminator = '\n' if args.log else '\r'
-        log(
-            '[{}] {}  ||  {}{}'.format(power['source'], ' - '.join(output), ' - '.join(output2), ' ' * 10),
-            end=terminator,
-        )
-        exit_event.wait(wait)
+        # all the power planes are sampled at the same time
+        now = monotonic()
+        dt, prev_t = now - prev_t, now
+        value = read_thermal_status() & causes_mask
+        output = ' - '.join(limited if value & mask else ok for mask, ok, limited in causes) if value else all_ok_output
+
+        # ugly code, just testing...
+        vcore = read_vcore() / (2.0 ** 13) * 1000
+        power_w = []
+        for index, (read, energy_unit, counter_range) in enumerate(energy_sources):
+            energy = read()
+            # the modulo takes care of the counter wrapping around since the last sample
+            power_w.append((energy - prev_energy[index]) % counter_range * energy_unit / dt)
+            prev_energy[index] = energy
+        # Package comes first in power_plane_msr
+        package_w = power_w[0] if package_w is None else 0.5 * package_w + 0.5 * power_w[0]
+
+        log(line_format.format(power['source'], output, vcore, *power_w, sum(power_w)), end=terminator)
+        # sample less often while the package is idle, so that the monitor itself does not keep it awake
+        schedule_once(idle_wait if package_w < MONITOR_IDLE_POWER_W else wait, tick)
+        return False
+
+    atexit.register(close_energy_fds)
+
+    log('[D] Realtime monitoring of throttling causes:\n')
+    tick()
+
+
+# handle dbus events for applying undervolt/IccMax on resume from sleep/hibernate
+def handle_sleep_callback(regs, wakeup, sleeping):
+    if not sleeping:
+        undervolt(regs)
+        set_icc_max(regs)
+        # the firmware might have reset the power limits while sleeping
+        wakeup()
+
+
+def handle_ac_callback(wakeup, if_name, changed, invalidated):
+    if "OnBattery" in changed:
+        power['method'] = 'dbus'
+        power['source'] = 'BATTERY' if bool(changed['OnBattery']) else 'AC'
+        wakeup()
+
+
+# dispatch all the signals from a single message filter
+def handle_dbus_message(regs, wakeup, bus, message):
+    interface, member = message.get_interface(), message.get_member()
+    if interface == 'org.freedesktop.login1.Manager' and member == 'PrepareForSleep':
+        handle_sleep_callback(regs, wakeup, *message.get_args_list())
+    elif (
+        interface == 'org.freedesktop.DBus.Properties'
+        and member == 'PropertiesChanged'
+        and message.get_path() == '/org/freedesktop/UPower'
+    ):
+        handle_ac_callback(wakeup, *message.get_args_list())
 
 
 def main():
@@ -959,6 +1363,7 @@ def main():
         cpuid = check_cpu()
 
     set_msr_allow_writes()
+    atexit.register(close_msr_fds)
 
     test_msr_rw_capabilities()
 
@@ -971,54 +1376,43 @@ def main():
 
     platform_info = get_cpu_platform_info()
     if args.debug:
-        for key, value in platform_info.items():
-            log('[D] cpu platform info: {} = {}'.format(key.replace("_", " "), value))
+        log(
+            '\n'.join(
+                '[D] cpu platform info: {} = {}'.format(key.replace("_", " "), value)
+                for key, value in platform_info.items()
+            )
+        )
     regs = calc_reg_values(platform_info, config)
 
     if not config.getboolean('GENERAL', 'Enabled'):
         log('[I] Throttled is disabled in config file... Quitting. :(')
         return
 
-    undervolt(config)
-    set_icc_max(config)
+    undervolt(regs)
+    set_icc_max(regs)
     set_hwp(config.getboolean('AC', 'HWP_Mode', fallback=None))
 
-    exit_event = Event()
-    thread = Thread(target=power_thread, args=(config, regs, exit_event, cpuid))
-    thread.daemon = True
-    thread.start()
-
-    # handle dbus events for applying undervolt/IccMax on resume from sleep/hibernate
-    def handle_sleep_callback(sleeping):
-        if not sleeping:
-            undervolt(config)
-            set_icc_max(config)
-
-    def handle_ac_callback(if_name, changed, invalidated):
-        if "OnBattery" in changed:
-            power['method'] = 'dbus'
-            power['source'] = 'BATTERY' if bool(changed['OnBattery']) else 'AC'
-
-    # add dbus receiver only if undervolt/IccMax is enabled in config
-    if any(
-        config.getfloat(key, plane, fallback=0) != 0 for plane in VOLTAGE_PLANES for key in UNDERVOLT_KEYS + ICCMAX_KEYS
-    ):
-        bus.add_signal_receiver(
-            handle_sleep_callback, 'PrepareForSleep', 'org.freedesktop.login1.Manager', 'org.freedesktop.login1'
-        )
-    bus.add_signal_receiver(
-        handle_ac_callback,
-        signal_name="PropertiesChanged",
-        dbus_interface="org.freedesktop.DBus.Properties",
-        path="/org/freedesktop/UPower",
-    )
+    wakeup = power_loop(config, regs, cpuid)
+
+    bus.add_message_filter(partial(handle_dbus_message, regs, wakeup))
+    # the match rules are sent without waiting for a reply from the bus, the sleep one is always
+    # needed since the firmware might reset the power limits while sleeping and resume wakes up the power loop
+    bus.add_match_string_non_blocking(SLEEP_MATCH_RULE)
+    bus.add_match_string_non_blocking(UPOWER_MATCH_RULE)
+    # when UPower is available its PropertiesChanged signal keeps track of the power source,
+    # so the power loop does not need to poll sysfs at every update
+    try:
+        power['source'] = 'BATTERY' if is_on_battery_upower(bus) else 'AC'
+        power['method'] = 'dbus'
+    except dbus.DBusException:
+        pass
+    if power['method'] == 'polling':
+        watch_sysfs_power_path(config, wakeup)
 
     log('[I] Starting main loop.')
 
     if args.monitor is not None:
-        monitor_thread = Thread(target=monitor, args=(exit_event, args.monitor))
-        monitor_thread.daemon = True
-        monitor_thread.start()
+        monitor(args.monitor)
 
     try:
         loop = GLib.MainLoop()
@@ -1026,11 +1420,7 @@ def main():
     except (KeyboardInterrupt, SystemExit):
         pass
 
-    exit_event.set()
     loop.quit()
-    thread.join(timeout=1)
-    if args.monitor is not None:
-        monitor_thread.join(timeout=0.1)
 
 
 if __name__ == '__main__':